@@ -3,7 +3,7 @@
 #
 # MODULE:       r.learn.parallel.predict
 # AUTHOR(S):    Anika Weinmann
-# PURPOSE:      Applies the classification model parallel using r.learn.predict
+# PURPOSE:      Applies the classification model in parallel
 # COPYRIGHT:    (C) 2020-2022 by mundialis GmbH & Co. KG and the GRASS
 #               Development Team
 #
@@ -20,7 +20,7 @@
 ############################################################################
 
 # %module
-# % description: Applies a classification model in parallel using r.learn.predict.
+# % description: Applies a classification model in parallel.
 # % keyword: raster
 # % keyword: classification
 # % keyword: regression
@@ -86,6 +86,11 @@
 # % guisection: Optional
 # %end
 
+# %option G_OPT_MEMORYMB
+# % description: Maximum memory to be used by r.patch (in MB)
+# % guisection: Optional
+# %end
+
 # %option
 # % key: grid
 # % type: integer
@@ -99,28 +104,43 @@ import atexit
 import sys
 import os
 import multiprocessing as mp
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
 
 import grass.script as grass
-from grass.pygrass.modules import Module, ParallelModuleQueue
+from grass.script import task as gtask
+from grass.pygrass.gis.region import Region
+from grass.pygrass.modules import Module
+from grass.pygrass.raster import RasterRow
+from grass.pygrass.raster.buffer import Buffer
 
 # initialize global vars
-rm_regions = []
-rm_vectors = []
 rm_rasters = []
+rm_mapsets = []
+
+# estimator loaded once by the parent and inherited by the forked processes
+model = None
+# mapset of a pool process running r.learn.predict.worker
+worker_mapset = None
+CELL_NULL = -2147483648
 
 
 def cleanup():
+    if not rm_rasters and not rm_mapsets:
+        return
     nuldev = open(os.devnull, "w")
     kwargs = {"flags": "f", "quiet": True, "stderr": nuldev}
-    for rmr in rm_regions:
-        if rmr in [x for x in grass.parse_command("g.list", type="region")]:
-            grass.run_command("g.remove", type="region", name=rmr, **kwargs)
-    for rmv in rm_vectors:
-        if grass.find_file(name=rmv, element="vector")["file"]:
-            grass.run_command("g.remove", type="vector", name=rmv, **kwargs)
-    for rmrast in rm_rasters:
-        if grass.find_file(name=rmrast, element="raster")["file"]:
-            grass.run_command("g.remove", type="raster", name=rmrast, **kwargs)
+    env = grass.gisenv()
+    if rm_rasters:
+        # list the existing rasters with a single g.list call
+        existing = set(grass.list_grouped("raster").get(env["MAPSET"], []))
+        names = [name for name in rm_rasters if name in existing]
+        if names:
+            grass.run_command("g.remove", type="raster", name=",".join(names), **kwargs)
+    for rmm in rm_mapsets:
+        grass.utils.try_rmdir(os.path.join(env["GISDBASE"], env["LOCATION_NAME"], rmm))
 
 
 def set_test_nprocs(nprocs):
@@ -139,9 +159,189 @@ def set_test_nprocs(nprocs):
         return nprocs
 
 
+def get_tile_borders(n_cells, n_tiles):
+    # cell indices of the tile borders for an even split into whole cells,
+    # the sizes of the tiles differ by at most one cell
+    return [round(i * n_cells / n_tiles) for i in range(n_tiles + 1)]
+
+
+def get_options(module):
+    # names of the options supported by the installed module
+    return {param["name"] for param in gtask.command_info(module)["params"]}
+
+
+def write_gisrc(mapset=None):
+    # writes a copy of the GISRC with a unique name, to memory if possible,
+    # optionally switched to another mapset
+    with open(os.environ["GISRC"]) as gisrc:
+        gisrc_lines = gisrc.readlines()
+    if mapset:
+        gisrc_lines = [line for line in gisrc_lines if not line.startswith("MAPSET:")]
+        gisrc_lines.append("MAPSET: %s\n" % mapset)
+    gisrc_dir = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+    fd, newgisrc = tempfile.mkstemp(dir=gisrc_dir, prefix="grassrc_")
+    try:
+        with os.fdopen(fd, "w") as gisrc:
+            gisrc.writelines(gisrc_lines)
+    except Exception:
+        grass.utils.try_remove(newgisrc)
+        raise
+    return newgisrc
+
+
+def create_worker_mapset(mapset, group_mapset):
+    # creates the mapset with an own GISRC, the group is used from its mapset
+    # via the search path
+    newgisrc = write_gisrc()
+    try:
+        env = os.environ.copy()
+        env["GISRC"] = newgisrc
+        grass.run_command("g.mapset", flags="c", mapset=mapset, env=env)
+        grass.run_command("g.mapsets", operation="add", mapset=group_mapset, env=env)
+    finally:
+        grass.utils.try_remove(newgisrc)
+
+
+def set_worker_mapset(mapset_queue):
+    # initializer of the pool processes, each process takes its own mapset
+    global worker_mapset
+    worker_mapset = mapset_queue.get()
+
+
+def run_worker(cat, tmp_output, bounds, worker_kwargs):
+    # runs r.learn.predict.worker synchronously inside a pool process in the
+    # mapset of this process
+    north, south, east, west = bounds
+    Module(
+        "r.learn.predict.worker",
+        north=north,
+        south=south,
+        east=east,
+        west=west,
+        mapset=worker_mapset,
+        output=tmp_output,
+        **worker_kwargs,
+    )
+    # r.learn.predict writes the class probabilities into maps with the output
+    # as prefix, with -z there is no classification map
+    tile_maps = {}
+    for name in grass.list_strings(
+        "raster", pattern="%s*" % tmp_output, mapset=worker_mapset
+    ):
+        map_name = name.split("@")[0]
+        if map_name == tmp_output or map_name.startswith(tmp_output + "_"):
+            tile_maps[map_name.replace(tmp_output, "", 1)] = name
+    return cat, tile_maps
+
+
+def load_estimator(load_model):
+    # r.learn.train stores the estimator, the training labels and the class
+    # labels together
+    try:
+        import joblib
+    except ImportError:
+        grass.fatal(_("Cannot import joblib, install scikit-learn first"))
+    loaded = joblib.load(load_model)
+    if isinstance(loaded, tuple):
+        return loaded[0], loaded[2] if len(loaded) > 2 else None
+    return loaded, None
+
+
+def get_total_memory_mb():
+    # physical memory in MB, None if it cannot be determined
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / 1024**2
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def set_model(estimator):
+    # initializer of the pool processes, the pool processes run in parallel
+    # already, so the estimator must not start own threads
+    global model
+    model = estimator
+    try:
+        from threadpoolctl import threadpool_limits
+
+        threadpool_limits(1)
+    except ImportError:
+        pass
+
+
+def get_tile_bounds(reg, row_borders, col_borders):
+    # bounds (north, south, east, west) of the tiles between the row and
+    # column borders, starting at the north-west corner of the region
+    tiles = []
+    for row, next_row in zip(row_borders[:-1], row_borders[1:]):
+        north = reg["n"] - row * reg["nsres"]
+        south = reg["n"] - next_row * reg["nsres"]
+        for col, next_col in zip(col_borders[:-1], col_borders[1:]):
+            west = reg["w"] + col * reg["ewres"]
+            east = reg["w"] + next_col * reg["ewres"]
+            tiles.append((north, south, east, west))
+    return tiles
+
+
+def read_rows(rast, start, end, data):
+    # reads the rows of an opened raster map into data with null cells as NaN
+    for i, row in enumerate(range(start, end)):
+        data[i] = rast[row]
+    if rast.mtype == "CELL":
+        data[data == CELL_NULL] = np.nan
+
+
+def predict_region(bands, estimator, output, mtype, chunksize, region):
+    # predicts the current raster window in chunks of whole rows with at most
+    # chunksize cells
+    rows, cols = region.rows, region.cols
+    chunk_rows = max(1, chunksize // cols)
+    # the bands are read pixel interleaved into one buffer, which is passed
+    # to the estimator without stacking or transposing the bands
+    features = np.empty((chunk_rows * cols, len(bands)), dtype=np.float32)
+    rasts = [RasterRow(band) for band in bands]
+    out = RasterRow(output)
+    try:
+        for rast in rasts:
+            rast.open("r")
+        out.open("w", mtype, overwrite=True)
+        buf = Buffer((cols,), mtype=mtype)
+        for start in range(0, rows, chunk_rows):
+            end = min(start + chunk_rows, rows)
+            chunk = features[: (end - start) * cols]
+            chunk_bands = chunk.reshape(end - start, cols, len(bands))
+            for i, rast in enumerate(rasts):
+                read_rows(rast, start, end, chunk_bands[:, :, i])
+            # raster nulls in any band are not passed to the estimator
+            valid = ~np.isnan(chunk).any(axis=1)
+            predicted = np.full(chunk.shape[0], np.nan)
+            if valid.all():
+                predicted[:] = estimator.predict(chunk)
+            elif valid.any():
+                predicted[valid] = estimator.predict(chunk[valid])
+            if mtype == "CELL":
+                predicted[~valid] = CELL_NULL
+            for row in predicted.reshape(end - start, cols):
+                buf[:] = row
+                out.put_row(buf)
+    finally:
+        for rast in rasts + [out]:
+            if rast.is_open():
+                rast.close()
+
+
+def predict_tile(cat, tmp_output, bounds, bands, mtype, chunksize):
+    # predicts a tile inside a pool process with the shared estimator
+    region = Region()
+    region.north, region.south, region.east, region.west = bounds
+    region.adjust()
+    region.set_raster_region()
+    predict_region(bands, model, tmp_output, mtype, chunksize, region)
+    return cat, tmp_output
+
+
 def main():
 
-    global rm_regions, rm_rasters, rm_vectors
+    global rm_mapsets
 
     # parallelization parameter
     n_jobs = set_test_nprocs(int(options["n_jobs"]))
@@ -151,15 +351,17 @@ def main():
     output = options["output"]
     load_model = options["load_model"]
     chunksize = options["chunksize"]
+    if int(chunksize) <= 0:
+        grass.fatal(_("The chunksize has to be larger than 0"))
     flags_str = ""
     for flag in flags:
         if flags[flag] and not flag == "v":
             flags_str += flag
 
     if options["grid"]:
-        grid_rows_cols = options["grid"]
+        grid_rows, grid_cols = [int(x) for x in options["grid"].split(",")]
     else:
-        grid_rows_cols = "%d,%d" % (n_jobs, n_jobs)
+        grid_rows, grid_cols = n_jobs, n_jobs
 
     # set some common environmental variables, like:
     os.environ.update(
@@ -180,79 +382,226 @@ def main():
             )
         )
 
+    tile_bounds = []
     if n_jobs > 1:
-        grass.message(_("Generating grid to for parallelization ..."))
-        grid = "tmp_grid_%s" % os.getpid()
-        grass.run_command("v.mkgrid", map=grid, grid=grid_rows_cols)
-        rm_vectors.append(grid)
-
+        grass.message(_("Computing the tiles for parallelization ..."))
         reg = grass.region()
-        cats = list(
-            grass.parse_command("v.category", input=grid, option="print").keys()
+        # each tile should contain at least chunksize cells, otherwise the
+        # overhead of the tiles exceeds the prediction time
+        max_tiles = max(1, reg["rows"] * reg["cols"] // int(chunksize))
+        if grid_rows * grid_cols > max_tiles:
+            # the larger dimension is reduced first to keep the grid aspect
+            while grid_rows * grid_cols > max_tiles:
+                if grid_rows >= grid_cols:
+                    grid_rows -= 1
+                else:
+                    grid_cols -= 1
+            grass.message(
+                _("Reducing the grid to %d rows and %d columns for small tiles")
+                % (grid_rows, grid_cols)
+            )
+        # the tile borders are on cell borders of the region, so a tile has
+        # at least one cell in each direction
+        grid_rows = min(grid_rows, reg["rows"])
+        grid_cols = min(grid_cols, reg["cols"])
+        grass.message(
+            _("Using a grid of %d rows and %d columns") % (grid_rows, grid_cols)
+        )
+        tile_bounds = get_tile_bounds(
+            reg,
+            get_tile_borders(reg["rows"], grid_rows),
+            get_tile_borders(reg["cols"], grid_cols),
         )
 
+    # no more processes are started than there are tiles, a single tile is
+    # predicted by r.learn.predict without a pool
+    n_workers = min(n_jobs, len(tile_bounds))
+    if n_workers > 1:
+        # the parallel processes should not start own threads and share half
+        # of the memory for the GDAL cache, if not set by the user
+        os.environ.setdefault("OMP_NUM_THREADS", "1")
+        os.environ.setdefault("MKL_NUM_THREADS", "1")
+        total_memory = get_total_memory_mb()
+        if "GDAL_CACHEMAX" not in os.environ and total_memory:
+            cache_mb = max(64, int(total_memory / n_workers / 2))
+            os.environ["GDAL_CACHEMAX"] = str(cache_mb)
+
+        # probabilities are only supported by r.learn.predict, so in this
+        # case the tiles are predicted by r.learn.predict.worker
+        use_worker = flags["p"] or flags["z"]
+        cats = [str(i) for i in range(1, len(tile_bounds) + 1)]
+
         grass.message(_("Predict parallel on the grid cells ..."))
         # save current mapset
         env = grass.gisenv()
         # start_gisdbase = env['GISDBASE']
         # start_location = env['LOCATION_NAME']
         start_cur_mapset = env["MAPSET"]
+        gisdbase = env["GISDBASE"]
+        location = env["LOCATION_NAME"]
 
-        queue = ParallelModuleQueue(nprocs=n_jobs)
-        classifications = []
-        for cat in cats:
-            new_mapset = "tmp_mapset_rlearnpredict_%s" % cat
-            tmp_output = "%s_%s" % (output, cat)
-            # Module
-            r_grid_predict = Module(
-                "r.learn.predict.worker",
-                area=grid,
-                where="cat=%s" % cat,
-                mapset=new_mapset,
+        # for the VRT the tiles stay referenced in their mapsets
+        keep_mapsets = flags["v"]
+        tiles = {}
+        if use_worker:
+            worker_mapsets = [
+                "tmp_mapset_rlearnpredict_%s_w%d" % (os.getpid(), i)
+                for i in range(n_workers)
+            ]
+            if not keep_mapsets:
+                rm_mapsets.extend(worker_mapsets)
+            group_mapset = grass.find_file(group, element="group")["mapset"]
+            if not group_mapset:
+                grass.fatal(_("Group <%s> not found") % group)
+
+            worker_kwargs = dict(
                 nsres=reg["nsres"],
                 ewres=reg["ewres"],
-                group=group,
-                output=tmp_output,
+                group="%s@%s" % (group.split("@")[0], group_mapset),
                 load_model=load_model,
-                run_=False,
                 chunksize=chunksize,
+                flags=flags_str,
             )
-            classifications.append("%s@%s" % (tmp_output, new_mapset))
-            queue.put(r_grid_predict)
-        queue.wait()
+            mp_context = mp.get_context("fork")
+            mapset_queue = mp_context.Queue()
+            for mapset in worker_mapsets:
+                mapset_queue.put(mapset)
+            with ProcessPoolExecutor(
+                max_workers=n_workers,
+                mp_context=mp_context,
+                initializer=set_worker_mapset,
+                initargs=(mapset_queue,),
+            ) as executor:
+                # the worker mapsets are created in the pool, which starts the
+                # pool processes while the mapsets are set up in parallel
+                setup_futures = [
+                    executor.submit(create_worker_mapset, mapset, group_mapset)
+                    for mapset in worker_mapsets
+                ]
+                for future in setup_futures:
+                    future.result()
+                futures = []
+                for cat, bounds in zip(cats, tile_bounds):
+                    tmp_output = "%s_%s" % (output, cat)
+                    futures.append(
+                        executor.submit(
+                            run_worker,
+                            cat,
+                            tmp_output,
+                            bounds,
+                            worker_kwargs,
+                        )
+                    )
+                try:
+                    for future in as_completed(futures):
+                        cat, tile_maps = future.result()
+                        tiles[cat] = tile_maps
+                        grass.verbose(_("Prediction of tile %s done") % cat)
+                except BaseException:
+                    # the pending tiles are cancelled when a tile fails, before
+                    # the pool is shut down
+                    for future in futures:
+                        future.cancel()
+                    raise
+        else:
+            # the estimator is loaded only once and shared with the forked
+            # pool processes, which write the tiles into the current mapset
+            # the bands are listed while the estimator is loaded
+            i_group = grass.pipe_command("i.group", group=group, flags="g")
+            estimator, class_labels = load_estimator(load_model)
+            try:
+                from sklearn.base import is_classifier
+            except ImportError:
+                grass.fatal(_("Cannot import scikit-learn, install it first"))
+            mtype = "CELL" if is_classifier(estimator) else "FCELL"
+            if "n_jobs" in estimator.get_params(deep=False):
+                estimator.set_params(n_jobs=1)
+            bands = grass.decode(i_group.communicate()[0]).split()
+            if i_group.returncode != 0:
+                grass.fatal(_("Cannot list the maps of group <%s>") % group)
+            with ProcessPoolExecutor(
+                max_workers=n_workers,
+                mp_context=mp.get_context("fork"),
+                initializer=set_model,
+                initargs=(estimator,),
+            ) as executor:
+                futures = []
+                for cat, bounds in zip(cats, tile_bounds):
+                    # the tiles referenced by the VRT stay with readable names,
+                    # the other tiles get unique names to not overwrite maps
+                    # like the class probabilities of r.learn.predict
+                    if flags["v"]:
+                        tmp_output = "%s_%s" % (output, cat)
+                    else:
+                        tmp_output = "tmp_rlearnpredict_%s_%s" % (os.getpid(), cat)
+                        rm_rasters.append(tmp_output)
+                    futures.append(
+                        executor.submit(
+                            predict_tile,
+                            cat,
+                            tmp_output,
+                            bounds,
+                            bands,
+                            mtype,
+                            int(chunksize),
+                        )
+                    )
+                try:
+                    for future in as_completed(futures):
+                        cat, tmp_output = future.result()
+                        tiles[cat] = {"": "%s@%s" % (tmp_output, start_cur_mapset)}
+                        grass.verbose(_("Prediction of tile %s done") % cat)
+                except BaseException:
+                    # the pending tiles are cancelled when a tile fails, before
+                    # the pool is shut down
+                    for future in futures:
+                        future.cancel()
+                    raise
+        # the tiles of the output and of each class probability map, the key
+        # is the suffix of the map name
+        outputs = {}
+        for cat in cats:
+            for suffix, tile in sorted(tiles[cat].items()):
+                outputs.setdefault(suffix, []).append(tile)
+        if not outputs:
+            grass.fatal(_("No tiles were predicted"))
 
-        # verify that switchiing the mapset worked
-        env = grass.gisenv()
-        gisdbase = env["GISDBASE"]
-        location = env["LOCATION_NAME"]
-        cur_mapset = env["MAPSET"]
-        if cur_mapset != start_cur_mapset:
-            grass.fatal(
-                "new mapset is %s, but should be %s" % (cur_mapset, start_cur_mapset)
+        # patching: the tiles are read directly from the mapsets they are
+        # predicted in, so the outputs are only written once
+        grass.message(_("Patching the tiles ..."))
+        grass.message(_("Current region for patching:\n%s") % reg)
+
+        patch_kwargs = {}
+        if not flags["v"]:
+            # parallel patching is only available in newer GRASS versions
+            patch_options = get_options("r.patch")
+            if "nprocs" in patch_options:
+                patch_kwargs["nprocs"] = n_workers
+            if "memory" in patch_options:
+                patch_kwargs["memory"] = options["memory"]
+        for suffix, suffix_tiles in outputs.items():
+            patch_output = output + suffix
+            if flags["v"]:
+                grass.run_command("r.buildvrt", input=suffix_tiles, output=patch_output)
+            else:
+                grass.run_command(
+                    "r.patch",
+                    input=suffix_tiles,
+                    output=patch_output,
+                    **patch_kwargs,
+                )
+
+        if not use_worker and isinstance(class_labels, dict) and not flags["v"]:
+            rules = "\n".join(
+                "%s|%s" % (value, label) for value, label in class_labels.items()
             )
-
-        for classification in classifications:
-            name_mapset = classification.split("@")
-            grass.run_command(
-                "g.copy", raster="%s,%s" % (classification, name_mapset[0])
+            grass.write_command(
+                "r.category", map=output, rules="-", separator="pipe", stdin=rules
             )
-            grass.utils.try_rmdir(os.path.join(gisdbase, location, name_mapset[1]))
-
-        # patching
-        grass.message(_("Patching the tiles ..."))
-        grass.message(_("Current region for patching:\n%s") % grass.region())
 
-        if len(classifications) > 1:
-            module = "r.patch"
-            if flags["v"]:
-                module = "r.buildvrt"
-            all_classified = [x.split("@")[0] for x in classifications]
-            grass.run_command(module, input=all_classified, output=output)
-            if not flags["v"]:
-                rm_rasters.extend(all_classified)
-        else:
-            all_classified = [x.split("@")[0] for x in classifications][0]
-            grass.run_command("g.copy", raster=all_classified + "," + output)
+        for mapset in rm_mapsets:
+            grass.utils.try_rmdir(os.path.join(gisdbase, location, mapset))
+        rm_mapsets = []
 
         grass.message(_("Patching the tiles done"))
     else:
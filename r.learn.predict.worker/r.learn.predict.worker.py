@@ -81,21 +81,44 @@
 # % required: yes
 # % multiple: no
 # % key_desc: name
-# % label: Name of mapset to create
+# % label: Name of existing mapset to use, the group has to be accessible from it
 # % guisection: Required
 # %end
 
-# %option G_OPT_V_INPUT
-# % key: area
-# % label: Input vector map to set the region with a where condition
+# %option
+# % key: north
+# % type: double
+# % required: yes
+# % multiple: no
+# % key_desc: value
+# % description: Value for the northern edge of the region
 # % guisection: Required
 # %end
-
-# %option G_OPT_DB_WHERE
-# % key: where
+# %option
+# % key: south
+# % type: double
 # % required: yes
 # % multiple: no
-# % label: Where condition to set the region to the area
+# % key_desc: value
+# % description: Value for the southern edge of the region
+# % guisection: Required
+# %end
+# %option
+# % key: east
+# % type: double
+# % required: yes
+# % multiple: no
+# % key_desc: value
+# % description: Value for the eastern edge of the region
+# % guisection: Required
+# %end
+# %option
+# % key: west
+# % type: double
+# % required: yes
+# % multiple: no
+# % key_desc: value
+# % description: Value for the western edge of the region
 # % guisection: Required
 # %end
 
@@ -121,17 +144,41 @@
 
 import sys
 import os
-import shutil
+import tempfile
 
 import grass.script as grass
 
 
+def write_gisrc(mapset=None):
+    # writes a copy of the GISRC with a unique name, to memory if possible,
+    # optionally switched to another mapset
+    with open(os.environ["GISRC"]) as gisrc:
+        gisrc_lines = gisrc.readlines()
+    if mapset:
+        gisrc_lines = [line for line in gisrc_lines if not line.startswith("MAPSET:")]
+        gisrc_lines.append("MAPSET: %s\n" % mapset)
+    gisrc_dir = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+    fd, newgisrc = tempfile.mkstemp(dir=gisrc_dir, prefix="grassrc_")
+    try:
+        with os.fdopen(fd, "w") as gisrc:
+            gisrc.writelines(gisrc_lines)
+    except Exception:
+        grass.utils.try_remove(newgisrc)
+        raise
+    return newgisrc
+
+
 def main():
 
     # parallelization parameter
-    new_mapset = options["mapset"]
-    area = options["area"]
-    where = options["where"]
+    mapset = options["mapset"]
+    bounds = dict(
+        n=options["north"],
+        s=options["south"],
+        e=options["east"],
+        w=options["west"],
+    )
+    bounds_str = "n=%(n)s, s=%(s)s, e=%(e)s, w=%(w)s" % bounds
     nsres = options["nsres"]
     ewres = options["ewres"]
 
@@ -154,52 +201,41 @@ def main():
         )
     )
 
-    grass.message(_("Prediction of region %s, %s...") % (area, where))
-
-    reg = grass.parse_command("v.db.select", flags="r", map=area, where=where)
-
-    # actual mapset, location, ...
-    env = grass.gisenv()
-    gisdbase = env["GISDBASE"]
-    location = env["LOCATION_NAME"]
-    old_mapset = env["MAPSET"]
-
-    grass.message("New mapset %s" % new_mapset)
-    grass.utils.try_rmdir(os.path.join(gisdbase, location, new_mapset))
-
-    gisrc = os.environ["GISRC"]
-    newgisrc = "%s_%s" % (gisrc, str(os.getpid()))
-    grass.try_remove(newgisrc)
-    shutil.copyfile(gisrc, newgisrc)
-    os.environ["GISRC"] = newgisrc
-
-    grass.message("GISRC: %s" % os.environ["GISRC"])
-    grass.run_command("g.mapset", flags="c", mapset=new_mapset)
-
-    # verify that switching the mapset worked
-    cur_mapset = grass.gisenv()["MAPSET"]
-    if cur_mapset != new_mapset:
-        grass.fatal("new mapset is %s, but should be %s" % (cur_mapset, new_mapset))
-
-    grass.run_command("g.region", flags="a", nsres=nsres, ewres=ewres, grow=1, **reg)
-    grass.message(_("current region (%s):\n%s") % (where, grass.region()))
-
-    # copy group to current mapset
-    grass.run_command("g.copy", group=group + "@" + old_mapset + "," + group)
-
-    # classification
-    grass.run_command(
-        "r.learn.predict",
-        group=group,
-        output=output,
-        load_model=load_model,
-        chunksize=chunksize,
-        flags=flags_str,
-        quiet=True,
-    )
+    grass.message(_("Prediction of region %s...") % bounds_str)
+
+    # switch to the worker mapset with an isolated GISRC
+    newgisrc = write_gisrc(mapset)
+    try:
+        os.environ["GISRC"] = newgisrc
+
+        grass.message("GISRC: %s" % os.environ["GISRC"])
+
+        # verify that switching the mapset worked
+        cur_mapset = grass.gisenv()["MAPSET"]
+        if cur_mapset != mapset:
+            grass.fatal("new mapset is %s, but should be %s" % (cur_mapset, mapset))
+
+        # the region is written to the WIND file of the worker mapset, the
+        # bounds are on cell borders of the parent region and are used without
+        # growing so that neighbouring tiles do not overlap
+        grass.run_command("g.region", nsres=nsres, ewres=ewres, **bounds)
+        grass.message(_("current region (%s):\n%s") % (bounds_str, grass.region()))
+
+        # classification
+        grass.run_command(
+            "r.learn.predict",
+            group=group,
+            output=output,
+            load_model=load_model,
+            chunksize=chunksize,
+            flags=flags_str,
+            quiet=True,
+        )
+    finally:
+        # the GISRC is not removed by the cleanup of the GRASS session
+        grass.utils.try_remove(newgisrc)
 
-    grass.message(_("Prediction of region %s, %s is done") % (area, where))
-    grass.utils.try_remove(newgisrc)
+    grass.message(_("Prediction of region %s is done") % bounds_str)
     return 0
 
 